@@ -1,17 +1,19 @@
 import argparse
+import concurrent.futures
 import io
 import logging
-import re
 import os
+import pickle
 import tempfile
 import time
 from datetime import datetime
 
-import requests
-
+import numpy as np
 import pandas as pd
-import matplotlib
-import matplotlib.pyplot as plt
+
+# Note: `matplotlib` and `requests` are imported where needed (plotting and
+# the cache-miss code path, respectively): importing them is relatively
+# expensive, and not needed for all code paths.
 
 
 log = logging.getLogger()
@@ -33,11 +35,9 @@ def main():
     )
 
     opts = parser.parse_args()
-    plot(
-        **process_data(
-            pd.read_csv(get_csv(), usecols=["date", "km", "min", "sec", "bodypump"]), opts
-        )
-    )
+    if opts.window_width_days < 1:
+        parser.error("window width must be at least 1 day")
+    plot(**process_data(get_df(), opts))
 
 
 def process_data(df, opts):
@@ -47,12 +47,8 @@ def process_data(df, opts):
     df = df[df.km.notnull() | df.bodypump.notnull()]
     #    df_bp = df_full[df_full.bodypump.notnull()]
 
-    # Parse text in `date` column into a pd.Series of `datetime64` type values
-    # and make this series be the new index of the data frame.
-    df.index = pd.to_datetime(df["date"])
-
-    # Sort data frame by index (sort from past to future).
-    df = df.sort_index()
+    # Note: the rows do not need to be sorted by date here. The per-day
+    # aggregation below (groupby) yields a sorted index (past to future).
 
     # Turn the data frame into a `pd.Series` object, representing the distance
     # ran over time. Every row / data point in this series represents a run:
@@ -60,10 +56,21 @@ def process_data(df, opts):
     # distance of the run.
     km_per_run = df["km"]
 
-    hours_per_run = (60 * df["min"] + df["sec"]) / 3600
+    # Do the per-run arithmetic on the raw NumPy arrays; there is no need for
+    # index alignment here (all columns share the same index).
+    minv = df["min"].to_numpy(dtype="float64")
+    secv = df["sec"].to_numpy(dtype="float64")
+    kmv = km_per_run.to_numpy(dtype="float64")
 
-    # minutes per km
-    avgspeed_per_run = hours_per_run * 60 / km_per_run
+    hours_per_run = pd.Series(
+        minv * (1.0 / 60.0) + secv * (1.0 / 3600.0), index=df.index
+    )
+
+    # minutes per km. A run logged with a distance of 0 yields inf (or NaN);
+    # like pandas, do not warn about that (see `rolling_sum_sum_mean()`).
+    with np.errstate(divide="ignore", invalid="ignore"):
+        avgspeed = (minv + secv * (1.0 / 60.0)) / kmv
+    avgspeed_per_run = pd.Series(avgspeed, index=df.index)
 
     # There may have been more than one run per day. In these cases, sum up the
     # distances and have a single row represent all runs of the day.
@@ -74,12 +81,24 @@ def process_data(df, opts):
     # 2019-07-11    5.4
     # 2019-07-17    4.5
 
-    # Group events per day and sum up the run distance:
-    km_per_run = km_per_run.groupby(km_per_run.index).sum()
-    hours_per_run = hours_per_run.groupby(hours_per_run.index).sum()
-    avgspeed_per_run = avgspeed_per_run.groupby(avgspeed_per_run.index).mean()
+    # Group events per day and sum up the run distance (and duration; average
+    # the speed). Do this in a single groupby operation so that the index is
+    # factorized only once:
+    per_day = (
+        pd.DataFrame(
+            {
+                "km": km_per_run,
+                "hours": hours_per_run,
+                "avgspeed": avgspeed_per_run,
+                "bodypump": df["bodypump"],
+            },
+            index=df.index,
+        )
+        .groupby(level=0)
+        .agg({"km": "sum", "hours": "sum", "avgspeed": "mean", "bodypump": "count"})
+    )
 
-    # Outcome for above's example (for `km_per_run`):
+    # Outcome for above's example (for the `km` column):
     # 2019-07-10    3.2
     # 2019-07-11    9.9
     # 2019-07-17    4.5
@@ -115,43 +134,70 @@ def process_data(df, opts):
     #   2019-05-30    0.0
     #   ...
     #
-    km_per_run = km_per_run.asfreq("1D", fill_value=0)
-    hours_per_run = hours_per_run.asfreq("1D", fill_value=0)
-    avgspeed_per_run = avgspeed_per_run.asfreq("1D", fill_value=None)
+    # Do not use `asfreq("1D")` for that (reindexing, i.e. hash-based
+    # alignment): build the daily index once, and scatter the values into
+    # the new series by their position (offset in days from the first day).
+    start = per_day.index.min()
+    full_index = pd.date_range(start, per_day.index.max(), freq="D")
+    pos = (per_day.index - start).days.to_numpy()
+
+    # Distance, duration and speed go into the columns of one (N, 3) array
+    # (see the rolling window analysis below, which handles all three columns
+    # at once). For the speed there is no meaningful fill value: use NaN.
+    per_day_values = np.zeros((len(full_index), 3))
+    per_day_values[:, 2] = np.nan
+    per_day_values[pos] = per_day[["km", "hours", "avgspeed"]].to_numpy(
+        dtype="float64"
+    )
+    km_per_run = pd.Series(per_day_values[:, 0], index=full_index)
+    hours_per_run = pd.Series(per_day_values[:, 1], index=full_index)
+    avgspeed_per_run = pd.Series(per_day_values[:, 2], index=full_index)
+
+    # Number of bodypump sessions per day.
+    bodypump_per_day = np.zeros(len(full_index))
+    bodypump_per_day[pos] = per_day["bodypump"].to_numpy()
 
     # Should be >= 7 to be meaningful.
     window_width_days = opts.window_width_days
-    window = km_per_run.rolling(window="%sD" % window_width_days)
 
+    # After the up-sampling above the index has a uniform spacing of one day,
+    # i.e. a time window of N days is the same as a window of N consecutive
+    # data points. That allows for using the fixed-width window functions
+    # below on the raw NumPy arrays (instead of pandas' offset-based rolling
+    # machinery).
+    #
     # For each window position get the sum of distances. For normalization,
     # divide this by the window width (in days) to get values of the unit
     # km/day -- and then convert to the new desired unit of km/week with an
-    # additional factor of 7.
-    km_per_week = window.sum() / (window_width_days / 7.0)
-
-    # Do the same for run duration and speed, in less code
-    hours_per_week = hours_per_run.rolling(window="%sD" % window_width_days).sum() / (
+    # additional factor of 7. Do the same for run duration, and get the mean
+    # of the speed. All three are computed in a single pass.
+    per_window_values = rolling_sum_sum_mean(per_day_values, window_width_days)
+    km_per_week = pd.Series(per_window_values[:, 0], index=full_index) / (
+        window_width_days / 7.0
+    )
+    hours_per_week = pd.Series(per_window_values[:, 1], index=full_index) / (
         window_width_days / 7.0
     )
-    avgspeed_per_week = avgspeed_per_run.rolling(
-        window="%sD" % window_width_days
-    ).mean()
+    avgspeed_per_week = pd.Series(per_window_values[:, 2], index=full_index)
 
     #print(df["bodypump"])
-    bpc = df["bodypump"].rolling(window="%sD" % window_width_days).count()
+    # Count bodypump sessions per window. Like the other rolling window
+    # analyses this operates on the uniform daily index; only keep the values
+    # for those days that have a record in the data set.
+    bpc = pd.Series(
+        rolling_sum(bodypump_per_day, window_width_days)[pos], index=per_day.index
+    )
     #print(bpc.tail(30))
     #import sys
     #sys.exit()
 
-    # During the rolling window analysis the value derived from the current
-    # window position is assigned to the right window boundary (i.e. to the
-    # newest timestamp in the window). For presentation it is more convenient
-    # and intuitive to have it assigned to the temporal center of the time
-    # window. Invoking `rolling(..., center=True)` however yields
-    # `NotImplementedError: center is not implemented for datetimelike and
-    # offset based windows`. As a workaround, shift the data by half the window
-    # size to 'the left': shift the timestamp index by a constant / offset.
-    offset = pd.DateOffset(days=window_width_days / 2.0)
+    # The window functions assign the value derived from the current window
+    # position to the right window boundary (i.e. to the newest timestamp in
+    # the window). For presentation it is more convenient and intuitive to
+    # have it assigned to the temporal center of the time window: shift the
+    # data by half the window size to 'the left', i.e. shift the timestamp
+    # index by a constant / offset.
+    offset = pd.Timedelta(days=window_width_days / 2.0)
     km_per_week.index = km_per_week.index - offset
     hours_per_week.index = hours_per_week.index - offset
     avgspeed_per_week.index = avgspeed_per_week.index - offset
@@ -173,6 +219,44 @@ def process_data(df, opts):
     return returndict
 
 
+def rolling_sum(a, w):
+    """
+    Sum over a window of (at most) `w` consecutive values (along the first
+    axis of `a`), assigned to the right window boundary. Like pandas'
+    offset-based rolling window the first `w-1` windows are partial (i.e.
+    `min_periods=1`). Computed from the cumulative sum: the sum over a window
+    is the difference of two cumulative sums.
+    """
+    c = np.cumsum(a, axis=0)
+    out = c.copy()
+    out[w:] -= c[:-w]
+    return out
+
+
+def rolling_sum_sum_mean(a, w):
+    """
+    Rolling window analysis over the three columns of the (N, 3) array `a`,
+    with the same window semantics as `rolling_sum()`: sum of column 0, sum
+    of column 1, and mean of column 2. Like pandas' `rolling().mean()` the
+    mean ignores non-finite values (NaN, and +/-inf from a run logged with a
+    distance of 0); windows without any finite value yield NaN. Note: an inf
+    must not enter the cumulative sum, it would turn into NaN when leaving the
+    window (inf - inf) and poison all subsequent windows.
+    """
+    finite = np.isfinite(a[:, 2])
+    # One cumulative sum pass over all columns: the two sums, the sum of the
+    # finite values of column 2, and the number of those values per window.
+    sums = rolling_sum(
+        np.column_stack([a[:, :2], np.where(finite, a[:, 2], 0.0), finite]), w
+    )
+    cnt = sums[:, 3]
+    mean = np.full(len(a), np.nan)
+    np.divide(sums[:, 2], cnt, out=mean, where=cnt > 0)
+    out = sums[:, :3]
+    out[:, 2] = mean
+    return out
+
+
 def plot(
     km_per_week,
     km_per_run,
@@ -183,128 +267,255 @@ def plot(
     window_width_days,
     bpc
 ):
-
-    plt.style.use("ggplot")
+    figures = [
+        # First, distance over time.
+        dict(
+            title="Running distance per week, over time",
+            ylabel="Distance [km]",
+            legend=[
+                "distance per week, rolling window mean (%s days)" % window_width_days,
+                "distance per day (raw data)",
+                "bodypump # per rw",
+            ],
+            series_week=km_per_week,
+            series_run=km_per_run,
+            series_bpc=bpc,
+        ),
+        # Now, run duration over time
+        dict(
+            title="Running duration per week, over time",
+            ylabel="Duration [hours]",
+            legend=[
+                "duration per week, rolling window mean (%s days)" % window_width_days,
+                "duration per day (raw data)",
+            ],
+            series_week=hours_per_week,
+            series_run=hours_per_run,
+        ),
+        # Now, run velocity over time
+        dict(
+            title="Running velocity per week, over time",
+            ylabel="Avg speed [min/km]",
+            legend=[
+                "avg speed per week, rolling window mean (%s days)"
+                % window_width_days,
+                "avg speed per day (raw data)",
+            ],
+            series_week=avgspeed_per_week,
+            series_run=avgspeed_per_run,
+        ),
+    ]
+
+    # Rendering (mainly PNG encoding) dominates the wall time of this
+    # program. The figures are independent of each other: render them in
+    # parallel, one process per figure, up to the number of CPUs. On a single
+    # CPU there is nothing to gain from that, and starting the worker
+    # processes (which set up matplotlib again) only adds cost: render
+    # in-process then.
+    workers = min(len(figures), os.cpu_count() or 1)
+    if workers == 1:
+        _init_plotting()
+        for kwargs in figures:
+            _render_one(**kwargs)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_plotting
+    ) as executor:
+        futures = [executor.submit(_render_one, **kwargs) for kwargs in figures]
+        for future in futures:
+            # Propagate exceptions from the worker processes.
+            future.result()
+
+
+def _init_plotting():
+    import matplotlib
+
+    # Render headless. Figures may be rendered in worker processes (see
+    # `plot()`).
+    matplotlib.use("Agg")
+
+    import matplotlib.style
+
+    matplotlib.style.use("ggplot")
     matplotlib_config()
 
-    # First, distance over time.
-    plt.figure()
-    ax = km_per_week.plot(linestyle="solid", color="black")
-    ax2 = km_per_run.plot(
-        linestyle="None", marker="x", color="gray", markersize=3, ax=ax
-    )
-    ax3 = bpc.plot(linestyle="None", marker='x', color='red', markersize=5, ax=ax)
-
-    ax2.set_xlabel("Time")
-    ax2.set_ylabel("Distance [km]")
-
-    ax2.legend(
-        [
-            "distance per week, rolling window mean (%s days)" % window_width_days,
-            "distance per day (raw data)",
-            "bodypump # per rw"
-        ],
-        numpoints=4,
-    )
-
-    title = "Running distance per week, over time"
-    plt.title(title)
-    plt.tight_layout()
-    savefig(title)
-
-    # Now, run duration over time
-    plt.figure()
-    ax = hours_per_week.plot(linestyle="solid", color="black")
-    ax2 = hours_per_run.plot(
-        linestyle="None", marker="x", color="gray", markersize=3, ax=ax
-    )
-
-    ax2.set_xlabel("Time")
-    ax2.set_ylabel("Duration [hours]")
-
-    ax2.legend(
-        [
-            "duration per week, rolling window mean (%s days)" % window_width_days,
-            "duration per day (raw data)",
-        ],
-        numpoints=4,
-    )
-
-    title = "Running duration per week, over time"
-    plt.title(title)
-    plt.tight_layout()
-    savefig(title)
 
-    # Now, run velocity over time
-    plt.figure()
-    ax = avgspeed_per_week.plot(linestyle="solid", color="black")
-    ax2 = avgspeed_per_run.plot(
-        linestyle="None", marker="x", color="gray", markersize=3, ax=ax
-    )
+def _render_one(title, ylabel, legend, series_week, series_run, series_bpc=None):
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
 
-    ax2.set_xlabel("Time")
-    ax2.set_ylabel("Avg speed [min/km]")
+    # Build the figure directly (not via pyplot): no global pyplot state.
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
 
-    ax2.legend(
-        [
-            "avg speed per week, rolling window mean (%s days)" % window_width_days,
-            "avg speed per day (raw data)",
-        ],
-        numpoints=4,
-    )
-
-    title = "Running velocity per week, over time"
-    plt.title(title)
-    plt.tight_layout()
-    savefig(title)
+    series_week.plot(linestyle="solid", color="black", ax=ax)
+    series_run.plot(linestyle="None", marker="x", color="gray", markersize=3, ax=ax)
+    if series_bpc is not None:
+        series_bpc.plot(
+            linestyle="None", marker="x", color="red", markersize=5, ax=ax
+        )
 
-    plt.show()
+    ax.set_xlabel("Time")
+    ax.set_ylabel(ylabel)
+    ax.legend(legend, numpoints=4)
+    ax.set_title(title)
+    fig.tight_layout()
+    savefig(fig, title)
 
 
-def get_csv():
+def get_df():
     dockey = os.environ["RUNNI_GSHEET_KEY"]
     tmpdirpath = tempfile.gettempdir()
-    cachepath = os.path.join(tmpdirpath, f"runni-{dockey[:5]}.csv.cache")
-
-    def _get_csv_text_from_file_cache_or_web():
-        # Read from cache if it exists and is not too old.
-        maxage_minutes = 10
-        if os.path.exists(cachepath):
-            if time.time() - os.stat(cachepath).st_mtime < 60 * maxage_minutes:
-                with open(cachepath, "rb") as f:
-                    log.info("read data from file cache")
-                    return f.read().decode("utf-8")
+    # Cache the parsed data frame (pickled), not the CSV text: a cache hit
+    # then does not need to parse the CSV data again.
+    cachepath = os.path.join(tmpdirpath, f"runni-{dockey[:5]}.df.cache")
+    etagpath = cachepath + ".etag"
+
+    # Read from cache if it exists and is not too old.
+    maxage_minutes = 10
+    try:
+        st = os.stat(cachepath)
+    except FileNotFoundError:
+        st = None
+
+    # Unpickling can execute code: ignore a cache file (in the shared temp
+    # directory) that was not created by the current user.
+    if st is not None and hasattr(os, "getuid") and st.st_uid != os.getuid():
+        st = None
+
+    cached_df = None
+    etag = None
+    if st is not None:
+        if time.time() - st.st_mtime < 60 * maxage_minutes:
+            cached_df = _read_df_cache(cachepath)
+            if cached_df is not None:
+                log.info("read data from file cache")
+                return cached_df
+        else:
+            # Stale cache: only load it if it can be revalidated, using the
+            # ETag stored along with the cached data.
+            try:
+                with open(etagpath, "rb") as f:
+                    etag = f.read().decode("utf-8")
+            except FileNotFoundError:
+                pass
+            if etag:
+                cached_df = _read_df_cache(cachepath)
+
+    # Cache miss (or stale cache). Read from web, store in cache. If the
+    # stale cache could be loaded, make this a conditional request: if the
+    # document did not change the response is a 304 without body, and the
+    # cached data can be reused.
+    headers = {}
+    if cached_df is not None:
+        headers["If-None-Match"] = etag
+
+    import requests
+
+    url = f"https://docs.google.com/spreadsheet/ccc?key={dockey}&output=csv"
+    log.info("read data from web")
+    resp = requests.get(url, headers=headers)
+
+    if resp.status_code == 304:
+        log.info("data did not change, use file cache")
+        # Mark cache as fresh.
+        os.utime(cachepath)
+        return cached_df
+
+    resp.raise_for_status()
+
+    # Pass the raw bytes to the CSV parser: pandas decodes while parsing
+    # (UTF-8 by default), no need to decode the whole buffer beforehand.
+    df = parse_csv(io.BytesIO(resp.content))
+
+    log.info("write data to file cache")
+    _write_file_atomically(
+        cachepath, pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL)
+    )
+    etag = resp.headers.get("ETag")
+    if etag:
+        _write_file_atomically(etagpath, etag.encode("utf-8"))
+    elif os.path.exists(etagpath):
+        os.remove(etagpath)
+
+    return df
+
+
+def _read_df_cache(path):
+    # A cache file that cannot be loaded (e.g. written by a different pandas
+    # version, or truncated) is treated as a cache miss.
+    try:
+        return pd.read_pickle(path)
+    except Exception as exc:
+        log.warning("cannot load file cache, ignore it: %s", exc)
+        return None
+
+
+def _write_file_atomically(path, data):
+    # Write to a temporary file in the same directory first, then rename it
+    # (atomic on POSIX): readers never see a partially written file.
+    tmppath = f"{path}.tmp-{os.getpid()}"
+    with open(tmppath, "wb") as f:
+        f.write(data)
+    os.replace(tmppath, path)
+
+
+def parse_csv(f):
+    # Read the numeric columns as float64 right away (no type inference), and
+    # make the `date` column the index of the data frame.
+    df = pd.read_csv(
+        f,
+        usecols=["date", "km", "min", "sec", "bodypump"],
+        dtype={"km": "float64", "min": "float64", "sec": "float64"},
+        index_col="date",
+    )
 
-        # Cache miss. Read from web, store in cache.
-        url = f"https://docs.google.com/spreadsheet/ccc?key={dockey}&output=csv"
-        log.info("read data from web")
-        resp = requests.get(url)
-        resp.raise_for_status()
+    # Rows without distance and without bodypump value do not describe an
+    # activity (e.g. notes or summary rows) and are ignored by
+    # `process_data()`. Their `date` column may not contain a date at all:
+    # drop these rows before parsing the dates.
+    df = df.dropna(subset=["km", "bodypump"], how="all")
 
-        with open(cachepath, "wb") as f:
-            log.info("write data to file cache")
-            f.write(resp.text.encode("utf-8"))
+    # Parse text in `date` column into `datetime64` type values (errors out
+    # for an activity row with an invalid date).
+    df.index = pd.to_datetime(df.index)
+    return df
 
-        return resp.text
 
-    return io.StringIO(_get_csv_text_from_file_cache_or_web())
+# Translation table for `str.translate()`: map each ASCII character other than
+# [a-z0-9] to a whitespace character.
+_SLUG_TABLE = {
+    c: " " for c in range(128) if not ("a" <= chr(c) <= "z" or "0" <= chr(c) <= "9")
+}
 
 
-def savefig(title):
+def savefig(fig, title):
     now = datetime.utcnow()
     today = now.strftime("%Y-%m-%d")
     # Lowercase, replace special chars with whitespace, join on whitespace.
-    cleantitle = "-".join(re.sub("[^a-z0-9]+", " ", title.lower()).split())
+    cleantitle = "-".join(title.lower().translate(_SLUG_TABLE).split())
     fname = today + "_" + cleantitle
     fpath_figure = fname + ".png"
     log.info("Writing PNG figure to %s", fpath_figure)
-    plt.savefig(fpath_figure, dpi=150)
+    fig.savefig(fpath_figure, dpi=150)
 
 
 def matplotlib_config():
+    import matplotlib
+
     matplotlib.rcParams["figure.figsize"] = [10.5, 7.0]
     matplotlib.rcParams["figure.dpi"] = 100
     matplotlib.rcParams["savefig.dpi"] = 150
+    # Reduce the work the Agg renderer does for the (long) line paths.
+    matplotlib.rcParams["path.simplify"] = True
+    matplotlib.rcParams["path.simplify_threshold"] = 1.0
+    matplotlib.rcParams["agg.path.chunksize"] = 10000
+    # Pin the font family to matplotlib's bundled default font: no lookup
+    # through the generic sans-serif fallback chain.
+    matplotlib.rcParams["font.family"] = "DejaVu Sans"
+    matplotlib.rcParams["text.hinting"] = "none"
 
 
 if __name__ == "__main__":